@@ -13,11 +13,29 @@
 # limitations under the License.
 
 # from crawler.crawl import Crawler
+import time
+import logging
+import threading
+from functools import lru_cache
 from flask import Flask, request, render_template, redirect, url_for
-from whoosh.index import open_dir
-from whoosh.qparser import QueryParser
 
 app = Flask(__name__)
+log = logging.getLogger(__name__)
+
+# Whoosh is only imported and the index only opened on the first search, see 'refresh_index'
+INDEX_DIR = "crawler/indexdir" # Location of the crawled Whoosh index
+ix = None # The crawled Whoosh index, shared by all requests
+ix_version = None # Version of the index that is currently opened, see 'get_index_version'
+ix_lock = threading.Lock() # Guards (re)opening the index when the crawler commits or rebuilds it
+query_parser = None # Shared parser for queries on the 'content' field
+corrector_searcher = None # Long-lived searcher backing the shared spelling corrector
+corrector = None # Shared corrector for the 'content' field
+corrector_lock = threading.Lock() # Whoosh readers are not safe to use from several threads at once
+SEARCH_CACHE_SIZE = 512 # Maximum number of distinct queries to keep cached
+SUGGESTION_CACHE_SIZE = 4096 # Maximum number of misspelled terms to remember a suggestion for
+SEARCH_CACHE_TTL = 60 # Seconds a cached search result stays valid
+RESULTS_LIMIT = 10 # Number of search results shown on the results page
+RESULT_FIELDS = ("url", "title", "teaser") # Stored fields the results page needs
 
 # def initialize_crawler():
 #     """
@@ -38,33 +56,109 @@ app = Flask(__name__)
 #     initialize_crawler()
 
 #region Helper Functions
-def get_spelling_suggestion(query, ix):
+def get_index_version(index):
+    """
+    Helper function to identify the current version of the index on disk.
+    The generation alone is not enough: a forced re-crawl recreates the index, which starts counting at the same generation again.
+    Its table of contents is rewritten on every commit though, so its modification time tells rebuilds apart.
+    Var 'index': The Whoosh index to check.
+    Returns: A tuple of the latest generation and the modification time of its table of contents.
+    """
+    generation = index.latest_generation()
+    try:
+        toc_modified = index.storage.file_modified("_%s_%s.toc" % (index.indexname, generation))
+    except OSError: # The crawler is replacing the index right now, the next search will see the new version
+        toc_modified = None
+    return generation, toc_modified
+
+def refresh_index():
+    """
+    Helper function to open the shared Whoosh index on the first search,
+    and to reopen it if the crawler has committed to it or rebuilt it since.
+    Returns: The up-to-date Whoosh index.
+    """
+    global ix, ix_version
+    if ix is None or get_index_version(ix) != ix_version:
+        with ix_lock: # Only one request should (re)open the index
+            from whoosh.index import open_dir # Imported here to keep the startup of the app light
+            if ix is None or get_index_version(ix) != ix_version: # Another request may have opened it already
+                new_ix = open_dir(INDEX_DIR)
+                new_version = get_index_version(new_ix)
+                invalidate_caches(new_ix) # Objects built from the old index are stale now
+                ix = new_ix
+                # Set last: requests only skip the lock once the version matches, so everything above must be ready
+                ix_version = new_version
+                log.info("Opened the index at generation %d.", new_version[0])
+    return ix
+
+def invalidate_caches(index):
+    """
+    Helper function to rebuild the shared objects that are derived from the index.
+    Called when the index is (re)opened, on the first search or because the crawler committed to or rebuilt the index.
+    Var 'index': The newly opened Whoosh index to build the objects from.
+    """
+    from whoosh.qparser import QueryParser # Imported here to keep the startup of the app light
+    global query_parser, corrector_searcher, corrector
+    query_parser = QueryParser("content", index.schema)
+    with corrector_lock:
+        if corrector_searcher is not None:
+            corrector_searcher.close()
+        corrector_searcher = index.searcher()
+        corrector = corrector_searcher.corrector("content")
+        suggest_term.cache_clear()
+    cached_search.cache_clear()
+
+@lru_cache(maxsize=SUGGESTION_CACHE_SIZE)
+def suggest_term(term):
+    """
+    Helper function to ask the corrector for a single misspelled term, so it is only asked once per term.
+    Must be called while holding 'corrector_lock'.
+    Var 'term': The analysed term that is not in the index.
+    Returns: The suggested term, or None if the corrector has no suggestion.
+    """
+    suggestion = corrector.suggest(term, limit=1) # Get one suggestion
+    return suggestion[0] if suggestion else None
+
+def get_spelling_suggestion(query):
     """
     Helper function to handle spelling correction suggestions.
+    Words that are already in the index are kept, so only actual typos are sent to the corrector.
     Var 'query': The query used for searching.
-    Var 'ix': The Whoosh indexer to use for determining spelling suggestions.
-    Returns: The suggested word if a typo is detected, and if not, returns None.
-    """
-    print_prefix = f"{get_spelling_suggestion.__name__} >"
-    with ix.searcher() as searcher: # Use the searcher context
-        corrector = searcher.corrector("content") # Create the corrector for the 'content' field
-        suggested_word = corrector.suggest(query, limit=1) # Get one suggestion
-    if suggested_word and suggested_word[0] != query:
-        print(f"{print_prefix} Found word suggestion '{suggested_word[0]}' for query: {query}'")
-        return suggested_word[0] # Return the suggested word
+    Returns: The suggested query if the corrector found a correction, and if not, returns None.
+    """
+    content_field = ix.schema["content"]
+    suggested_words = []
+    corrected = False # Whether any word was actually corrected
+    with corrector_lock:
+        reader = corrector_searcher.reader()
+        for word in query.split():
+            terms = list(content_field.process_text(word)) # Analyse the word the same way the indexer did
+            if all(("content", term) in reader for term in terms): # Known words (and stop words) need no correction
+                suggested_words.append(word)
+                continue
+            suggestions = [suggest_term(term) for term in terms]
+            if any(suggestions):
+                corrected = True
+                suggested_words.append(" ".join(suggestion or term for term, suggestion in zip(terms, suggestions)))
+            else: # Keep the word as typed, the analysed form alone is no correction
+                suggested_words.append(word)
+    if corrected:
+        suggested_query = " ".join(suggested_words)
+        log.debug("Found word suggestion '%s' for query: '%s'", suggested_query, query)
+        return suggested_query # Return the suggested query
     else:
-        print(f"{print_prefix} No word suggestions found for query: {query}'")
+        log.debug("No word suggestions found for query: '%s'", query)
         return None
 
-def execute_search(query, ix):
+def execute_search(query, searcher):
     """
     Helper function to execute the search on the Whoosh index.
     Var 'query': The query used for searching.
-    Var 'ix': The Whoosh indexer to use for searching.
+    Var 'searcher': The Whoosh searcher to use for searching.
     Returns: The Whoosh search results as a list.
     """
-    whoosh_query = QueryParser("content", ix.schema).parse(query) # Parse query to a Whoosh query
-    results = ix.searcher().search(whoosh_query) # Search on this query
+    whoosh_query = query_parser.parse(query) # Parse query to a Whoosh query
+    results = searcher.search(whoosh_query, limit=RESULTS_LIMIT, terms=False) # Only score the top results
     return results
 
 def prepare_search_results(results):
@@ -75,12 +169,24 @@ def prepare_search_results(results):
     """
     found_urls = []
     for result in results:
-        found_urls.append({ # Append only the URLs, title and teaser to the list
-            "url": result["url"],
-            "title": result["title"],
-            "teaser": result["teaser"],
-        })
+        fields = result.fields() # Load the stored fields of the result once
+        found_urls.append({key: fields[key] for key in RESULT_FIELDS}) # Keep only the URLs, title and teaser
     return found_urls
+
+@lru_cache(maxsize=SEARCH_CACHE_SIZE)
+def cached_search(query, index_version, ttl_window):
+    """
+    Helper function to run the search logic once per query and cache the outcome.
+    Var 'query': The query used for searching.
+    Var 'index_version': The index version the results belong to (see 'get_index_version'), so a rebuilt index never hits old entries.
+    Var 'ttl_window': The current time window of SEARCH_CACHE_TTL seconds, so entries expire when it moves on.
+    Returns: A tuple of the found search result data and the spelling suggestion (or None).
+    """
+    corrected_query = get_spelling_suggestion(query)
+    with ix.searcher() as searcher:
+        results = execute_search(query, searcher)
+        found_urls = prepare_search_results(results) # Read stored fields while the searcher is open
+    return tuple(found_urls), corrected_query
 #endregion
 
 #region App Routes
@@ -89,7 +195,7 @@ def home():
     """
     Home route, shows the home page.
     """
-    print(f"{home.__name__} > Drawing the home page.")
+    log.debug("Drawing the home page.")
     return render_template("home.html")
 
 @app.route("/search", endpoint="search")
@@ -100,26 +206,24 @@ def search():
     query = request.args.get("q") # Get the input query from the form
     frisky = request.args.get("frisky") # If the user pressed the "I'm Feeling Frisky..." button
     if query:
-        print_prefix = f"{search.__name__} >"
-        print(f"{print_prefix} Searching for: '{query}'")
-        ix = open_dir("crawler/indexdir") # Open the crawled Whoosh index
-        # Call helper functions for search logic
-        corrected_query = get_spelling_suggestion(query, ix)
-        results = execute_search(query, ix)
-        found_urls = prepare_search_results(results)
+        log.debug("Searching for: '%s'", query)
+        refresh_index() # Pick up a newly crawled index before consulting the cache
+        ttl_window = int(time.monotonic() // SEARCH_CACHE_TTL)
+        found_urls, corrected_query = cached_search(query, ix_version, ttl_window)
         # Check if the "I'm Feeling Frisky..." button was clicked
-        if frisky and results:
-            return redirect(results[0]["url"]) # Redirect to the first result's URL
+        if frisky and found_urls:
+            return redirect(found_urls[0]["url"]) # Redirect to the first result's URL
         else: # Log results and render template
-            print(f"{print_prefix} For the search '{query}', found URLs: {found_urls}. Drawing the search results page.")
+            log.debug("For the search '%s', found URLs: %s. Drawing the search results page.", query, found_urls)
             return render_template("search.html",
                                    results=found_urls,
                                    query=query,
                                    corrected_query=corrected_query)
     else: # If the user somehow input nothing, return empty results
-        print(f"{print_prefix} Input search query is empty. Drawing empty search results page.")
+        log.debug("Input search query is empty. Drawing empty search results page.")
         return render_template("search.html", results=[], query=query)
 #endregion
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(funcName)s > %(message)s")
     app.run(debug=True)
\ No newline at end of file
@@ -13,23 +13,95 @@
 # limitations under the License.
 
 import os
-import bleach
+import time
 import requests
+import logging
 import argparse
+import threading
+from functools import lru_cache
 from openai import OpenAI
-from bs4 import BeautifulSoup
+from bleach.sanitizer import Cleaner
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
 from dotenv import load_dotenv
-from urllib.parse import urljoin, urlparse
-from whoosh.index import create_in, exists_in
+from urllib.parse import urljoin, urlparse, urlunparse
+from urllib.robotparser import RobotFileParser
+from whoosh.index import create_in, exists_in, clean_files
 from whoosh.fields import Schema, TEXT, ID
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 # from whoosh.qparser import QueryParser
 
 load_dotenv() # Load OpenAI API key
 
+log = logging.getLogger(__name__)
+
+MAX_PAGE_BYTES = 10 * 1024 * 1024 # Pages larger than this are cut off to avoid pathological downloads
+NON_CONTENT_TAGS = ["script", "style", "noscript"] # Tags whose text should never end up in the index
+USER_AGENT = "RillSearchBot" # Name the crawler identifies itself with towards robots.txt
+
+thread_state = threading.local() # State that each crawler worker thread keeps for itself
+
+def get_cleaner():
+    """
+    Get the bleach Cleaner of the current thread, creating it on first use.
+    A Cleaner is expensive to set up but not thread-safe, so every worker thread reuses its own.
+    Returns: The bleach Cleaner of the current thread, configured like bleach.clean().
+    """
+    cleaner = getattr(thread_state, "cleaner", None)
+    if cleaner is None:
+        cleaner = thread_state.cleaner = Cleaner()
+    return cleaner
+
+@lru_cache(maxsize=4096)
+def get_netloc(url):
+    """
+    Get the server/network location of a URL, cached because the same links appear on many pages.
+    Var 'url': The URL to get the network location of.
+    Returns: The network location of the URL.
+    """
+    return urlparse(url).netloc
+
+def canonicalize_url(url):
+    """
+    Bring a URL into a canonical form, so different spellings of the same page are only crawled once.
+    Drops the fragment and empty query, lowercases the server and gives an empty path the root path.
+    Var 'url': The URL to canonicalize.
+    Returns: The canonical form of the URL.
+    """
+    parts = urlparse(url)
+    return urlunparse(parts._replace(netloc=parts.netloc.lower(), path=parts.path or "/", fragment=""))
+
 class Crawler:
-    def __init__(self, start_url, index_dir):
+    def __init__(self, start_url, index_dir, max_workers=16, path_prefix=None, crawl_delay=0.0):
         self.start_url = start_url # Start crawling from this URL
+        canonical_start_url = canonicalize_url(start_url) # Compare against links in the same form they are crawled in
+        self.start_netloc = get_netloc(canonical_start_url) # Server that crawled URLs must belong to
+        if path_prefix is None: # Default to the folder of the start URL
+            start_path = urlparse(canonical_start_url).path
+            path_prefix = start_path[:start_path.rfind("/") + 1]
+        self.path_prefix = path_prefix # Path that crawled URLs must start with
+        self.max_workers = max_workers # Number of pages that are crawled at the same time
         self.visited_urls = set() # Easier than a list (prevents duplicates)
+        self.visited_lock = threading.Lock() # Makes checking and adding visited URLs atomic between threads
+        self.crawl_delay = crawl_delay # Minimum seconds between fetches from one server, unless robots.txt sets one
+        self.robots = {} # Cached robots.txt parser per server, so every robots.txt is only fetched once
+        self.robots_lock = threading.Lock()
+        self.last_fetch = {} # Time of the latest (reserved) fetch per server
+        self.last_fetch_lock = threading.Lock()
+        self.stopping = threading.Event() # Set when the crawl is aborted, so waiting workers give up their turn
+        self.session = requests.Session() # Reuse connections between pages (HTTP keep-alive)
+        self.session.headers["User-Agent"] = f"{USER_AGENT} (+https://github.com/RillJ/rill-search)" # Identify the crawler
+        # Keep one pooled connection per worker, so concurrent fetches don't open and discard extra connections
+        adapter = HTTPAdapter(pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        try: # One OpenAI client for all pages, so its connections are reused as well (it is thread-safe)
+            self.openai_client = OpenAI(
+                api_key=os.environ.get("OPENAI_API_KEY"),
+            )
+        except Exception as e: # Without an API key, teasers fall back to truncated content
+            log.warning("Failed to set up the OpenAI API client, teasers will be truncated content: %s", e)
+            self.openai_client = None
         if not os.path.exists(index_dir):
             os.mkdir(index_dir) # Create Whoosh index folder if it doesn't exist
         # Setting up Whoosh index
@@ -40,52 +112,160 @@ class Crawler:
             content=TEXT
         )
         self.index = create_in(index_dir, schema)
-        self.writer = self.index.writer()
+        # One writer for the whole crawl, buffering postings in RAM and writing a single segment on commit.
+        # It runs in this process: documents arrive one at a time at network speed, so sub-processes wouldn't help
+        self.writer = self.index.writer(limitmb=256)
+        self.writer_lock = threading.Lock() # The Whoosh writer must only be used by one thread at a time
 
     def start_crawling(self):
         """
         Start crawling from the initial URL input when creating the class.
+        Pages are crawled by a pool of worker threads, and the links they find are handed back to the pool.
         """
-        print_prefix = f"{self.start_crawling.__name__} >"
-        print(f"{print_prefix} Starting to crawl now!")
-        self.crawl_page(self.start_url)
-        self.writer.commit() # Once all pages have been crawled, commit to Whoosh
-        print(f"{print_prefix} Finished crawling!")
+        log.info("Starting to crawl now with %d workers!", self.max_workers)
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                pending = {executor.submit(self.crawl_page, canonicalize_url(self.start_url))}
+                try:
+                    while pending: # Crawling is done once no page is being crawled anymore
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            for url in future.result(): # Crawl the links found on the page
+                                pending.add(executor.submit(self.crawl_page, url))
+                except BaseException: # Leaving the executor waits for all queued pages, which would be thrown away anyway
+                    self.stopping.set()
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+        except BaseException: # Don't leave a half-written index and its write lock behind
+            self.writer.cancel()
+            # Remove the segment files written so far, the freshly created index has no segments to keep
+            clean_files(self.index.storage, self.index.indexname, self.index.latest_generation(), [])
+            raise
+        self.writer.commit() # Once all pages have been crawled, commit to Whoosh in one go
+        log.info("Finished crawling!")
 
     def crawl_page(self, url):
         """
         Crawl a single page, index the page content and parse the links on the page.
         Var 'url': The URL that will be crawled.
         Appends: The 'visited_urls' set.
+        Returns: A list of the URLs linked from the page that still need to be crawled.
         """
-        print_prefix = f"{self.crawl_page.__name__} >"
-        if url in self.visited_urls: # Skip already visited URLs
-            print(f"{print_prefix} The URL {url} has already been visited. Ignoring.")
+        with self.visited_lock: # Claim the URL so no other thread crawls it as well
+            already_visited = url in self.visited_urls
+            self.visited_urls.add(url) # Add the visited URL to the set
+        if already_visited: # Skip already visited URLs
+            log.debug("The URL %s has already been visited. Ignoring.", url)
+        elif not self.is_allowed_by_robots(url): # Skip URLs the server asks crawlers to stay away from
+            log.debug("The URL %s is disallowed by robots.txt. Ignoring.", url)
         else:
-            print(f"{print_prefix} Currently crawling the URL: {url}")
-            response = requests.get(url) # Fetch URL
-            if response.headers["Content-Type"].startswith("text/html"): # Only process HTML responses
-                self.visited_urls.add(url) # Add the visited URL to the set
-                print(f"{print_prefix} Successfully added {url} to the set.")
-                self.index_page(url, response.text) # Index the page content
-                self.parse_links(url, response.text) # Parse the links on the page
+            log.debug("Currently crawling the URL: %s", url)
+            self.wait_for_turn(url) # Don't hammer the server
+            if self.stopping.is_set(): # The crawl was aborted while waiting
+                return []
+            try:
+                html = self.fetch_html(url) # Fetch URL
+            except requests.RequestException as e: # One unreachable page shouldn't end the whole crawl
+                log.warning("Failed to fetch %s, skipping it: %s", url, e)
+                return []
+            if html is not None: # Only process HTML responses
+                tree = LexborHTMLParser(html) # Parse the page once for both indexing and links
+                found_urls = self.parse_links(url, tree) # Parse the links on the page before indexing trims the tree
+                self.index_page(url, tree) # Index the page content
+                return found_urls
             else:
-                print(f"{print_prefix} The URL {url} is not a HTML document. Ignoring.")
+                log.debug("The URL %s is not a HTML document. Ignoring.", url)
+        return []
 
-    def parse_links(self, base_url, html):
+    def get_robots(self, url):
         """
-        Parse links in the URL's HTML content and crawl these links.
-        This makes the link crawling recursive until it has crawled all pages.
+        Get the parsed robots.txt of the server the URL belongs to, fetching it on first use.
+        Var 'url': The URL whose server's robots.txt is needed.
+        Returns: The RobotFileParser for the server of the URL.
+        """
+        netloc = get_netloc(url)
+        with self.robots_lock:
+            robots = self.robots.get(netloc)
+            if robots is None:
+                robots_url = urljoin(url, "/robots.txt")
+                robots = RobotFileParser(robots_url)
+                try: # Fetch through the session (with a timeout), following the rules of RobotFileParser.read()
+                    response = self.session.get(robots_url, timeout=10)
+                    if response.status_code in (401, 403) or response.status_code >= 500: # Server errors mean "stay away" too
+                        robots.disallow_all = True
+                    elif response.status_code >= 400: # No robots.txt, so no rules
+                        robots.allow_all = True
+                    else:
+                        robots.parse(response.text.splitlines())
+                except requests.RequestException as e:
+                    log.warning("Failed to fetch %s, allowing all URLs: %s", robots_url, e)
+                    robots.allow_all = True
+                self.robots[netloc] = robots
+        return robots
+
+    def is_allowed_by_robots(self, url):
+        """
+        Verify if the robots.txt of the URL's server allows the crawler to fetch the URL.
+        Var 'url': The URL that will be checked.
+        Returns: True if the URL may be fetched and False if not.
+        """
+        return self.get_robots(url).can_fetch(USER_AGENT, url)
+
+    def wait_for_turn(self, url):
+        """
+        Wait until the crawl delay has passed since the latest fetch from the URL's server.
+        The Crawl-delay of the server's robots.txt takes precedence over the crawler's own delay.
+        Var 'url': The URL that is about to be fetched.
+        """
+        delay = self.get_robots(url).crawl_delay(USER_AGENT) or self.crawl_delay
+        if not delay:
+            return
+        netloc = get_netloc(url)
+        with self.last_fetch_lock: # Reserve the next free slot, so waiting threads queue up behind each other
+            now = time.monotonic()
+            fetch_time = max(now, self.last_fetch.get(netloc, now - delay) + delay)
+            self.last_fetch[netloc] = fetch_time
+        self.stopping.wait(fetch_time - now) # Sleep, unless the crawl is aborted in the meantime
+
+    def fetch_html(self, url):
+        """
+        Download a page, but only if it is an HTML document.
+        The body is streamed, so non-HTML responses are closed before their body is downloaded.
+        Var 'url': The URL that will be downloaded.
+        Returns: The HTML of the page (cut off after MAX_PAGE_BYTES), or None if it is not an HTML document.
+        """
+        with self.session.get(url, stream=True, timeout=10) as response: # Only the headers are read at first
+            if not response.headers.get("Content-Type", "").startswith("text/html"):
+                return None # Closing the response skips downloading the body
+            body = bytearray()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                body += chunk
+                if len(body) >= MAX_PAGE_BYTES:
+                    log.debug("The URL %s is larger than %d bytes. Cutting it off.", url, MAX_PAGE_BYTES)
+                    break
+            return body[:MAX_PAGE_BYTES].decode(response.encoding or "utf-8", errors="replace")
+
+    def parse_links(self, base_url, tree):
+        """
+        Parse links in the URL's HTML content that should be crawled next.
         Var 'base_url': The URL that was crawled.
-        Var 'html': Scraped plaintext HTML content of the crawled URL in question.
+        Var 'tree': The parsed HTML tree of the crawled URL in question.
+        Returns: A list of the unvisited linked URLs that are on the same server and path as the start URL.
         """
-        print_prefix = f"{self.parse_links.__name__} >"
-        soupie = BeautifulSoup(html, "html.parser")
-        for a in soupie.find_all("a", href=True):
-            full_url = urljoin(base_url, a['href'])
-            print(f"{print_prefix} Parsing the URL: {full_url}")
-            if self.is_same_server(full_url):
-                self.crawl_page(full_url)
+        # Deduplicate the links first (keeping their order), as navigation often links the same pages repeatedly
+        # Canonicalize them as well, so they match the canonical URLs in 'visited_urls'
+        linked_urls = dict.fromkeys(canonicalize_url(urljoin(base_url, a.attributes["href"] or ""))
+                                    for a in tree.css("a[href]"))
+        with self.visited_lock:
+            new_urls = [full_url for full_url in linked_urls if full_url not in self.visited_urls]
+        found_urls = []
+        debug = log.isEnabledFor(logging.DEBUG) # Check once instead of for every link
+        for full_url in new_urls:
+            if debug:
+                log.debug("Parsing the URL: %s", full_url)
+            if self.is_same_server(full_url) and self.is_within_path(full_url):
+                found_urls.append(full_url)
+        return found_urls
 
     def is_same_server(self, url):
         """
@@ -93,45 +273,53 @@ class Crawler:
         Var 'url': The URL that needs to be compared to the start URL.
         Returns: True if it is on the same server and False if not.
         """
-        print_prefix = f"{self.is_same_server.__name__} >"
-        start_netloc = urlparse(self.start_url).netloc
-        url_netloc = urlparse(url).netloc
-        if start_netloc == url_netloc:
-            print(f"{print_prefix} The URL {url} is on the same server as {start_netloc}.")
+        if get_netloc(url) == self.start_netloc:
+            log.debug("The URL %s is on the same server as %s.", url, self.start_netloc)
+            return True
+        else:
+            log.debug("The URL %s is not on the same server as %s. Ignoring.", url, self.start_netloc)
+            return False
+
+    def is_within_path(self, url):
+        """
+        Verify if the input URL lies below the path prefix the crawl is restricted to.
+        Var 'url': The URL that needs to be compared to the path prefix.
+        Returns: True if its path starts with the path prefix and False if not.
+        """
+        if urlparse(url).path.startswith(self.path_prefix):
             return True
         else:
-            print(f"{print_prefix} The URL {url} is not on the same server as {start_netloc}. Ignoring.")
+            log.debug("The URL %s is not below the path %s. Ignoring.", url, self.path_prefix)
             return False
 
-    def extract_title(self, soupie, url):
+    def extract_title(self, tree, url):
         """
         Attempts to extract the HTML title of a webpage.
-        Var 'soupie': The BeautifulSoup instance of the HTML webpage the title will be extracted from.
+        Var 'tree': The parsed HTML tree of the webpage the title will be extracted from.
         Var 'url': The URL of the same HTML webpage.
         Returns: The title of the HTML, or if not found, the URL as a fallback.
         """
-        print_prefix = f"{self.extract_title.__name__} >"
-        if soupie.title:
-            title = soupie.title.string.strip()
-            print(f"{print_prefix} Found the title '{title}' in the URL: {url}")
+        title_node = tree.css_first("title")
+        title = title_node.text(strip=True) if title_node is not None else ""
+        if title:
+            log.debug("Found the title '%s' in the URL: %s", title, url)
             return title
         else:
-            print(f"{print_prefix} Didn't find a page title in the URL {url}. Defaulting to URL.")
+            log.debug("Didn't find a page title in the URL %s. Defaulting to URL.", url)
             return url
 
-    def extract_body_content(self, soupie):
+    def extract_body_content(self, tree):
         """
         Attempts to extract the HTML body content of a webpage.
-        Var 'soupie': The BeautifulSoup instance of the HTML webpage the body will be extracted from.
+        Var 'tree': The parsed HTML tree of the webpage the body will be extracted from.
         Returns: The body content form the HTML, or if not found, an error message as a fallback.
         """
-        print_prefix = f"{self.extract_body_content.__name__} >"
-        body = soupie.find("body")
-        if body:
-            print(f"{print_prefix} Found body content.")
-            return body.get_text(strip=True)
+        body = tree.body
+        if body is not None:
+            log.debug("Found body content.")
+            return " ".join(body.text(separator=" ").split()) # Collapse whitespace between words in C, without a regex
         else:
-            print(f"{print_prefix} Didn't find body content. Defaulting to error message.")
+            log.debug("Didn't find body content. Defaulting to error message.")
             return "No body found on this web page."
 
     def generate_teaser(self, content, title):
@@ -141,48 +329,47 @@ class Crawler:
         Var 'title': The title of the web page to be summarized.
         Returns: The LLM-summarized teaser, or if this process failed, truncated content as a fallback.
         """
-        print_prefix = f"{self.generate_teaser.__name__} >"
-        sanitized_content = bleach.clean(content) # Prevent XSS attacks
-        try:
-            client = OpenAI(
-                api_key=os.environ.get("OPENAI_API_KEY"),
-            )
-            system_prompt = """
-            You are an assistant that creates concise teaser summaries from webpage content for a search engine.
-            Highlight important text using HTML, not markdown, by surrounding it with <b> tags, like this: <b>important text</b>.
-            """
-            user_prompt = f"Summarize the content for the page called {title}: {sanitized_content[:4000]}" # Don't send the whole webpage to the website to prevent token limits
-            response = client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                model="gpt-4o-mini"
-            )
-            teaser = response.choices[0].message.content.strip()
-            print(f"{print_prefix} Succesfully generated a teaser summary with ChatGPT: {teaser}")
-            return teaser
-        except Exception as e: # Fall back to truncating content if ChatGPT fails
-            print(f"{print_prefix} Failed to generate teaser using OpenAI API: {e}")
-            if len(sanitized_content) > 300:
-                return sanitized_content[:300] + "..."
-            else:
-                return sanitized_content
+        # Don't send the whole webpage to prevent token limits, and only sanitize what is actually used
+        sanitized_content = get_cleaner().clean(content[:4000]) # Prevent XSS attacks
+        if self.openai_client is not None:
+            try:
+                system_prompt = """
+                You are an assistant that creates concise teaser summaries from webpage content for a search engine.
+                Highlight important text using HTML, not markdown, by surrounding it with <b> tags, like this: <b>important text</b>.
+                """
+                user_prompt = f"Summarize the content for the page called {title}: {sanitized_content}"
+                response = self.openai_client.chat.completions.create(
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_prompt}
+                    ],
+                    model="gpt-4o-mini"
+                )
+                teaser = response.choices[0].message.content.strip()
+                log.debug("Succesfully generated a teaser summary with ChatGPT: %s", teaser)
+                return teaser
+            except Exception as e: # Fall back to truncating content if ChatGPT fails
+                log.warning("Failed to generate teaser using OpenAI API: %s", e)
+        if len(sanitized_content) > 300:
+            return sanitized_content[:300] + "..."
+        else:
+            return sanitized_content
 
-    def index_page(self, url, html):
+    def index_page(self, url, tree):
         """
         Use the Whoosh library to index the HTML title and content found on the given page.
         Var 'url': The URL of the HTML page that contains text content.
-        Var 'html': Scraped plaintext HTML content of the crawled URL in question.
+        Var 'tree': The parsed HTML tree of the crawled URL in question.
         """
-        soupie = BeautifulSoup(html, "html.parser")
+        tree.strip_tags(NON_CONTENT_TAGS) # Drop non-content tags so they are never walked or indexed
         # Extract indexing components
-        title = self.extract_title(soupie, url)
-        body_content = self.extract_body_content(soupie)
+        title = self.extract_title(tree, url)
+        body_content = self.extract_body_content(tree)
         teaser = self.generate_teaser(body_content, title)
         # Add the crawled URL to the Whoosh index
-        self.writer.add_document(url=url, content=body_content, title=title, teaser=teaser)
-        print(f"{self.index_page.__name__} > Indexed content from the URL {url} with the title '{title}'.")
+        with self.writer_lock:
+            self.writer.add_document(url=url, content=body_content, title=title, teaser=teaser)
+        log.debug("Indexed content from the URL %s with the title '%s'.", url, title)
 
     # def search(self, query):
     #     """
@@ -211,10 +398,16 @@ if __name__ == "__main__":
     parser.add_argument("--start-url", default="https://vm009.rz.uos.de/crawl/index.html", help="Starting URL for the crawler.")
     parser.add_argument("--index-dir", default="indexdir", help="Directory to store the Whoosh index into.")
     parser.add_argument("--force", action=argparse.BooleanOptionalAction, help="Forces crawling even if an index already exists.")
+    parser.add_argument("--workers", type=int, default=16, help="Number of pages to crawl at the same time.")
+    parser.add_argument("--path-prefix", help="Only crawl URLs whose path starts with this prefix. Defaults to the folder of the start URL.")
+    parser.add_argument("--verbose", action=argparse.BooleanOptionalAction, help="Log every step of the crawl.")
+    parser.add_argument("--delay", type=float, default=0.0, help="Minimum seconds between requests to the server, unless its robots.txt sets a Crawl-delay.")
     args = parser.parse_args() # Get the user entered arguments into a variable
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format="%(funcName)s > %(message)s")
     # Start crawling unless an index already exists 
     if exists_in(args.index_dir) and not args.force:
         print(f"An index has already been built in '{args.index_dir}'.")
     else:
-        crawler = Crawler(start_url=args.start_url, index_dir=args.index_dir)
+        crawler = Crawler(start_url=args.start_url, index_dir=args.index_dir, max_workers=args.workers,
+                          path_prefix=args.path_prefix, crawl_delay=args.delay)
         crawler.start_crawling()
\ No newline at end of file